@@ -1,10 +1,34 @@
+import hashlib
+import io
+import os
+import tempfile
+import threading
+from pathlib import Path
+
 import streamlit as st
 import pandas as pd
+import numpy as np
+import pyarrow.parquet as pq
+import matplotlib
+matplotlib.use("Agg")  # o app só gera PNGs (ver exibir_figura)
 import matplotlib.pyplot as plt
+from matplotlib.collections import LineCollection
+from matplotlib.colors import to_rgba_array
+from matplotlib.figure import Figure
+from matplotlib.lines import Line2D
 
 # -------------------------------------------------------------------
 # CONFIGURAÇÃO DA PÁGINA
 # -------------------------------------------------------------------
+# Figuras mais leves: cada rerun renderiza todos os gráficos de novo
+plt.rcParams.update({
+    "figure.dpi": 80,
+    "savefig.dpi": 80,
+    "path.simplify": True,
+    "path.simplify_threshold": 1.0,
+    "agg.path.chunksize": 10_000,
+})
+
 st.set_page_config(
     page_title="Dashboard – Gráficos",
     layout="wide"
@@ -27,83 +51,310 @@ O foco aqui é:
 # -------------------------------------------------------------------
 # FUNÇÕES AUXILIARES
 # -------------------------------------------------------------------
-@st.cache_data
-def load_df_final(file) -> pd.DataFrame:
-    """Carrega df_final.parquet a partir de upload."""
-    return pd.read_parquet(file)
+# As funções cacheadas recebem frames/arquivos com prefixo "_" (o Streamlit não
+# os hasheia) e são identificadas pela chave do upload, calculada uma vez por rerun.
+# Cada combinação de "Tipos a carregar" gera uma chave nova, então os caches em
+# memória guardam só as MAX_ENTRADAS_CACHE mais recentes.
+MAX_ENTRADAS_CACHE = 4
+
+# df_long já preparado (só com todos os tipos do arquivo) fica salvo aqui, por
+# hash do upload, entre reinícios do app; só os MAX_ENTRADAS_CACHE arquivos mais
+# recentes da versão atual são mantidos (ver _limpar_cache_disco).
+# Incrementar VERSAO_CACHE_DF_LONG sempre que o formato de df_long mudar.
+CACHE_DIR = Path(".cache")
+VERSAO_CACHE_DF_LONG = 4
+
+
+@st.cache_data(max_entries=MAX_ENTRADAS_CACHE)
+def listar_colunas(_file, chave_arquivo: str) -> list:
+    """Nomes das colunas de df_final.parquet, lidos só do esquema (sem decodificar dados)."""
+    esquema = pq.ParquetFile(_file).schema_arrow
+    indices = (esquema.pandas_metadata or {}).get("index_columns", [])
+    return [nome for nome in esquema.names if nome not in indices]
 
 
-def preparar_df_long(df: pd.DataFrame) -> pd.DataFrame:
+@st.cache_data(max_entries=MAX_ENTRADAS_CACHE)
+def load_df_final(_file, chave_arquivo: str, colunas=None) -> pd.DataFrame:
+    """Carrega df_final.parquet a partir de upload (só as `colunas` pedidas, se houver)."""
+    return pd.read_parquet(_file, columns=colunas)
+
+
+def _montar_df_long(df: pd.DataFrame) -> pd.DataFrame:
     """
     Reproduz a lógica do graficos.ipynb:
 
     - Mantém 'Município' como id_vars
-    - Derrete as demais colunas
+    - Empilha as demais colunas (equivalente a um melt, sem parsing por linha)
     - Separa 'ano' e 'tipo' a partir do nome da coluna (ex: '2017_geral')
     - Garante que 'valor' é numérico
-    - Cria colunas normalizadas por tipo (min–max e z-score)
+    - Ordena as linhas por tipo, Município e ano (ver fatiar_df_long)
+
+    As colunas normalizadas por tipo são criadas sob demanda (ver adicionar_normalizacao).
     """
     if "Município" not in df.columns:
         raise ValueError("Coluna 'Município' não encontrada em df_final.parquet.")
 
     value_cols = [col for col in df.columns if col != "Município"]
 
-    df_long = df.melt(
-        id_vars="Município",
-        value_vars=value_cols,
-        var_name="ano_variavel",
-        value_name="valor",
+    # Separa ano e tipo uma vez por coluna (ex: '2017_geral' -> ano=2017, tipo='geral')
+    partes = [str(col).split("_", 1) for col in value_cols]
+    if any(len(p) != 2 for p in partes):
+        raise ValueError("Colunas de df_final.parquet devem seguir o padrão '<ano>_<tipo>'.")
+    anos = np.array([int(p[0]) for p in partes], dtype=np.int16)
+    tipos = np.array([p[1] for p in partes], dtype=object)
+
+    # Empilha as colunas na mesma ordem do df.melt (coluna a coluna)
+    n_linhas = len(df)
+    df_long = pd.DataFrame({
+        "Município": np.tile(df["Município"].to_numpy(), len(value_cols)),
+        "valor": df[value_cols].to_numpy().reshape(-1, order="F"),
+        "ano": np.repeat(anos, n_linhas),
+        "tipo": np.repeat(tipos, n_linhas),
+    })
+
+    # Poucos valores distintos: categorias tornam groupby, isin e == comparações de códigos
+    df_long["tipo"] = df_long["tipo"].astype("category")
+    df_long["Município"] = df_long["Município"].astype("category")
+
+    # Garante que valor é numérico e float32 (basta para agregações e gráficos;
+    # downcast="float" sozinho mantém float64 se algum valor perde precisão)
+    df_long["valor"] = pd.to_numeric(
+        df_long["valor"], errors="coerce", downcast="float"
+    ).astype(np.float32)
+
+    # Blocos contíguos por tipo e município, para as consultas de fatiar_df_long
+    # (categorias são ordenadas, então a ordenação segue os códigos)
+    return df_long.sort_values(["tipo", "Município", "ano"]).reset_index(drop=True)
+
+
+def _limpar_cache_disco():
+    """
+    Remove de CACHE_DIR os df_long de versões antigas e, da versão atual,
+    tudo além dos MAX_ENTRADAS_CACHE arquivos mais recentes.
+    """
+    atuais = []
+    for arquivo in CACHE_DIR.glob("df_long_v*_*.parquet"):
+        if arquivo.name.startswith(f"df_long_v{VERSAO_CACHE_DF_LONG}_"):
+            atuais.append(arquivo)
+        else:
+            arquivo.unlink(missing_ok=True)
+
+    atuais.sort(key=lambda arquivo: arquivo.stat().st_mtime, reverse=True)
+    for arquivo in atuais[MAX_ENTRADAS_CACHE:]:
+        arquivo.unlink(missing_ok=True)
+
+
+@st.cache_data(show_spinner=False, max_entries=MAX_ENTRADAS_CACHE)
+def preparar_df_long(_df: pd.DataFrame, chave: str, persistir: bool = True) -> pd.DataFrame:
+    """
+    Monta df_long (ver _montar_df_long) reaproveitando o resultado salvo em
+    disco, sob a mesma `chave`, por uma execução anterior do app.
+
+    Com persistir=False (subconjunto de tipos) o disco não é usado, para não
+    acumular um arquivo por combinação de tipos.
+    """
+    if not persistir:
+        return _montar_df_long(_df)
+
+    caminho = CACHE_DIR / f"df_long_v{VERSAO_CACHE_DF_LONG}_{chave}.parquet"
+    if caminho.exists():
+        try:
+            return pd.read_parquet(caminho)
+        except Exception:
+            # Arquivo corrompido (ex.: escrita interrompida): descarta e remonta
+            caminho.unlink(missing_ok=True)
+
+    df_long = _montar_df_long(_df)
+    temporario = None
+    try:
+        CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        # Escreve num temporário e renomeia: o caminho final nunca fica pela metade
+        with tempfile.NamedTemporaryFile(dir=CACHE_DIR, suffix=".tmp", delete=False) as tmp:
+            temporario = Path(tmp.name)
+        df_long.to_parquet(temporario, compression="zstd", index=False)
+        os.replace(temporario, caminho)
+        _limpar_cache_disco()
+    except Exception:
+        # Cache em disco é só otimização (sem permissão de escrita, erro do
+        # pyarrow ao serializar...): segue apenas com o cache em memória
+        pass
+    finally:
+        # Após o os.replace o temporário já não existe; se a escrita falhou, some aqui
+        if temporario is not None:
+            temporario.unlink(missing_ok=True)
+    return df_long
+
+
+@st.cache_data(show_spinner=False, max_entries=MAX_ENTRADAS_CACHE)
+def estatisticas_por_tipo(_df_long: pd.DataFrame, chave: str) -> pd.DataFrame:
+    """min, max, média e desvio de 'valor' por tipo, na ordem das categorias de 'tipo'."""
+    return (
+        _df_long.groupby("tipo", observed=True)["valor"]
+        .agg(["min", "max", "mean", "std"])
+        .reindex(_df_long["tipo"].cat.categories)
     )
 
-    # Separa ano e tipo (ex: '2017_geral' -> ano=2017, tipo='geral')
-    df_long[["ano", "tipo"]] = df_long["ano_variavel"].str.split("_", n=1, expand=True)
-    df_long["ano"] = df_long["ano"].astype(int)
 
-    # Garante que valor é numérico
-    df_long["valor"] = pd.to_numeric(df_long["valor"], errors="coerce")
+def adicionar_normalizacao(df_sel: pd.DataFrame, stats: pd.DataFrame, coluna: str) -> pd.DataFrame:
+    """
+    Devolve df_sel com a coluna normalizada pedida ('valor_minmax_tipo' ou
+    'valor_zscore_tipo'), calculada só para as linhas selecionadas, mas com as
+    estatísticas do tipo inteiro (stats, de estatisticas_por_tipo).
+    """
+    # Estatísticas replicadas para as linhas com um único gather pelos códigos de 'tipo'
+    codigos = df_sel["tipo"].cat.codes.to_numpy()
+    mn, mx, m, sd = stats.to_numpy(dtype=np.float32).T[:, codigos]
+    v = df_sel["valor"].to_numpy(dtype=np.float32)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        if coluna == "valor_minmax_tipo":
+            # Normalização min–max por tipo (tipos sem variação ficam em 0)
+            rng = mx - mn
+            normalizado = np.where((rng == 0) | np.isnan(rng), 0.0, (v - mn) / rng)
+        elif coluna == "valor_zscore_tipo":
+            # Normalização z-score por tipo (desvio nulo ou indefinido fica em 0)
+            normalizado = np.where((sd == 0) | np.isnan(sd), 0.0, (v - m) / sd)
+        else:
+            raise ValueError(f"Normalização desconhecida: {coluna}")
+
+    return df_sel.assign(**{coluna: normalizado})
+
+
+def fatiar_df_long(df_long: pd.DataFrame, tipo, municipio=None) -> pd.DataFrame:
+    """
+    Linhas de um tipo (e, opcionalmente, de um município) de df_long.
+
+    df_long vem ordenado por tipo, Município e ano (ver _montar_df_long), então
+    cada grupo é um bloco contíguo localizado por busca binária nos códigos das
+    categorias e devolvido como fatia, sem varrer nem copiar o frame.
+    """
+    codigos_tipo = df_long["tipo"].cat.codes.to_numpy()
+    c = df_long["tipo"].cat.categories.get_loc(tipo)
+    ini, fim = np.searchsorted(codigos_tipo, [c, c + 1])
+
+    if municipio is not None:
+        codigos_mun = df_long["Município"].cat.codes.to_numpy()[ini:fim]
+        c = df_long["Município"].cat.categories.get_loc(municipio)
+        a, b = np.searchsorted(codigos_mun, [c, c + 1])
+        ini, fim = ini + a, ini + b
+
+    return df_long.iloc[ini:fim]
 
-    # Normalização min–max por tipo
-    def _minmax(s):
-        mn, mx = s.min(), s.max()
-        if pd.isna(mn) or pd.isna(mx) or mx == mn:
-            return pd.Series(0.0, index=s.index)
-        return (s - mn) / (mx - mn)
 
-    df_long["valor_minmax_tipo"] = (
-        df_long.groupby("tipo")["valor"].transform(_minmax)
+@st.cache_resource(show_spinner=False, max_entries=MAX_ENTRADAS_CACHE)
+def ordem_rankings(_df_long: pd.DataFrame, chave: str) -> dict:
+    """
+    Posições (iloc) das linhas de df_long de cada (tipo, ano), já ordenadas por
+    'valor' decrescente (NaN no fim), para que o ranking da seção 3 não seja
+    reordenado a cada rerun. Guarda só índices inteiros, não outra cópia dos dados,
+    e como cache_resource é devolvido sem cópia (somente leitura).
+    """
+    ordem = _df_long.sort_values(
+        ["tipo", "ano", "valor"], ascending=[True, True, False], na_position="last"
     )
+    posicoes = ordem.index.to_numpy()  # df_long tem RangeIndex: rótulo == posição
+    grupos = ordem.groupby(["tipo", "ano"], observed=True, sort=False).indices
+    return {grupo: posicoes[idx] for grupo, idx in grupos.items()}
 
-    # Normalização z-score por tipo
-    def _zscore(s):
-        m, std = s.mean(), s.std()
-        if pd.isna(m) or pd.isna(std) or std == 0:
-            return pd.Series(0.0, index=s.index)
-        return (s - m) / std
 
-    df_long["valor_zscore_tipo"] = (
-        df_long.groupby("tipo")["valor"].transform(_zscore)
+@st.cache_data(show_spinner=False, max_entries=MAX_ENTRADAS_CACHE)
+def calcular_resumos(_df_long: pd.DataFrame, chave: str):
+    """
+    Médias de 'valor' usadas pelas seções, agregadas uma única vez por upload:
+
+    - por (tipo, Município): ranking do período (seção 1)
+    - por (tipo, ano): tendência global (seção 1)
+
+    O ranking de um ano (seção 3) vem de ordem_rankings.
+    """
+    media_tipo_municipio = _df_long.groupby(["tipo", "Município"], observed=True)["valor"].mean()
+    media_tipo_ano = _df_long.groupby(["tipo", "ano"], observed=True)["valor"].mean()
+    return media_tipo_municipio, media_tipo_ano
+
+
+@st.cache_data(show_spinner=False, max_entries=MAX_ENTRADAS_CACHE)
+def valores_unicos(_df_long: pd.DataFrame, chave: str):
+    """Tipos, municípios e anos disponíveis (ordenados) para os widgets."""
+    tipos = sorted(_df_long["tipo"].cat.categories.tolist())
+    municipios = sorted(_df_long["Município"].cat.categories.tolist())
+    anos = sorted(_df_long["ano"].unique().tolist())
+    return tipos, municipios, anos
+
+
+@st.cache_resource(show_spinner=False)
+def obter_figura(chave: str, figsize: tuple):
+    """
+    Figure/Axes persistentes de um gráfico, reaproveitados entre reruns em vez
+    de recriados a cada interação (quem usa faz ax.clear() antes de desenhar).
+
+    Criados fora do pyplot, que não guarda referência a eles. Como o
+    cache_resource é compartilhado entre sessões, o lock deve ser mantido
+    do ax.clear() até exibir_figura.
+    """
+    fig = Figure(figsize=figsize)
+    ax = fig.add_subplot()
+    return fig, ax, threading.Lock()
+
+
+def exibir_figura(fig):
+    """
+    Renderiza a figura em PNG no DPI do rcParams e a mostra com st.image,
+    esticada na largura da coluna como o st.pyplot fazia.
+
+    O st.pyplot salva sempre com dpi=200, o que anularia o limite de DPI acima.
+    """
+    buf = io.BytesIO()
+    fig.savefig(buf, format="png", bbox_inches="tight")
+    st.image(buf, width="stretch")
+
+
+def plot_serie_temporal(df_plot, x_col, y_col, group_col, xlabel, ylabel, title, chave_figura):
+    """
+    Faz um lineplot simples com um grupo por linha (uma única LineCollection),
+    desenhado na figura persistente `chave_figura` (ver obter_figura).
+    """
+    # Uma coluna por grupo, alinhadas pelo eixo x; pivot_table já devolve x e
+    # grupos ordenados numa única passada, sem ordenação extra por grupo
+    wide = df_plot.pivot_table(
+        index=x_col, columns=group_col, values=y_col, aggfunc="mean", observed=True
     )
 
-    return df_long
+    fig, ax, lock = obter_figura(chave_figura, (8, 4))
+    with lock:
+        ax.clear()
+        _desenhar_series(fig, ax, wide, xlabel, ylabel, title)
+        exibir_figura(fig)
+
 
+def _desenhar_series(fig, ax, wide, xlabel, ylabel, title):
+    """Desenha em `ax` uma linha com marcadores por coluna de `wide` (x no índice)."""
+    x = wide.index.to_numpy(dtype=float)
+    y = wide.to_numpy(dtype=float)
 
-def plot_serie_temporal(df_plot, x_col, y_col, group_col, xlabel, ylabel, title):
-    """Faz um lineplot simples com um grupo por linha."""
-    fig, ax = plt.subplots(figsize=(10, 5))
+    ciclo = plt.rcParams["axes.prop_cycle"].by_key()["color"]
+    cores = to_rgba_array([ciclo[i % len(ciclo)] for i in range(y.shape[1])])
 
-    for group, dados in df_plot.groupby(group_col):
-        dados = dados.sort_values(x_col)
-        ax.plot(dados[x_col], dados[y_col], marker="o", label=str(group))
+    segments = [np.column_stack([x, y[:, i]]) for i in range(y.shape[1])]
+    ax.add_collection(LineCollection(segments, colors=cores))
+    ax.scatter(
+        np.tile(x, y.shape[1]), y.ravel(order="F"),
+        c=np.repeat(cores, len(x), axis=0), s=36, zorder=3,
+    )
+    ax.autoscale_view()
+
+    # Handles "proxy" para manter a legenda com uma entrada por grupo
+    handles = [
+        Line2D([], [], color=cor, marker="o", label=str(group))
+        for group, cor in zip(wide.columns, cores)
+    ]
 
     ax.set_title(title)
     ax.set_xlabel(xlabel)
     ax.set_ylabel(ylabel)
     ax.grid(alpha=0.3)
-    ax.legend(loc="upper left", bbox_to_anchor=(1, 1))
+    ax.legend(handles=handles, loc="upper left", bbox_to_anchor=(1, 1))
     fig.tight_layout()
 
-    st.pyplot(fig)
-
 
 # -------------------------------------------------------------------
 # SIDEBAR – CARREGAMENTO DO df_final
@@ -119,19 +370,49 @@ if file_df_final is None:
     st.warning("Carregue o arquivo **df_final.parquet** na barra lateral para continuar.")
     st.stop()
 
+chave_arquivo = hashlib.md5(file_df_final.getvalue()).hexdigest()
+
+# Tipos presentes no arquivo, a partir dos nomes '<ano>_<tipo>' das colunas
+colunas_arquivo = listar_colunas(file_df_final, chave_arquivo)
+tipos_arquivo = sorted({
+    col.split("_", 1)[1] for col in colunas_arquivo if col != "Município" and "_" in col
+})
+
+tipos_carregar = st.sidebar.multiselect(
+    "Tipos a carregar",
+    options=tipos_arquivo,
+    default=tipos_arquivo
+)
+
+if not tipos_carregar:
+    st.warning("Selecione ao menos um tipo de indicador para carregar na barra lateral.")
+    st.stop()
+
+# Só as colunas dos tipos escolhidos são lidas do Parquet; colunas fora do
+# padrão '<ano>_<tipo>' continuam sendo lidas para que o erro seja reportado
+colunas_carregar = [
+    col for col in colunas_arquivo
+    if col == "Município" or "_" not in col or col.split("_", 1)[1] in tipos_carregar
+]
+
 # Carrega e prepara
-df_final = load_df_final(file_df_final)
+df_final = load_df_final(file_df_final, chave_arquivo, colunas_carregar)
+chave_upload = hashlib.md5(
+    f"{chave_arquivo}|{'|'.join(sorted(tipos_carregar))}".encode()
+).hexdigest()
 
 try:
-    df_long = preparar_df_long(df_final)
+    df_long = preparar_df_long(
+        df_final, chave_upload, persistir=len(tipos_carregar) == len(tipos_arquivo)
+    )
 except Exception as e:
     st.error(f"Erro ao preparar df_long: {e}")
     st.stop()
 
+media_tipo_municipio, media_tipo_ano = calcular_resumos(df_long, chave_upload)
+
 # Valores únicos
-tipos_disponiveis = sorted(df_long["tipo"].unique())
-municipios_disponiveis = sorted(df_long["Município"].unique())
-anos_disponiveis = sorted(df_long["ano"].unique())
+tipos_disponiveis, municipios_disponiveis, anos_disponiveis = valores_unicos(df_long, chave_upload)
 
 st.success(f"Dataset carregado com sucesso! Linhas: {df_final.shape[0]:,} | Colunas: {df_final.shape[1]}")
 
@@ -177,14 +458,14 @@ with col_sel_top:
         top_n = st.slider("Quantidade de municípios (Top N)", 3, 30, 10)
 
 # Filtra por tipo
-df_tipo = df_long[df_long["tipo"] == tipo_escolhido].copy()
+df_tipo = fatiar_df_long(df_long, tipo_escolhido)
 
 # Se não sobrou nada numérico
 if df_tipo["valor"].notna().sum() == 0:
     st.warning(f"Para o tipo `{tipo_escolhido}`, não há valores numéricos válidos em `valor`.")
 else:
     # Define top N municípios por média de valor no período
-    rank_media = df_tipo.groupby("Município")["valor"].mean().sort_values(ascending=False)
+    rank_media = media_tipo_municipio.loc[tipo_escolhido].sort_values(ascending=False)
     if limitar_municipios:
         top_muns = rank_media.head(top_n).index
         df_plot_tipo = df_tipo[df_tipo["Município"].isin(top_muns)]
@@ -200,24 +481,26 @@ else:
         xlabel="Ano",
         ylabel="Valor do indicador",
         title=f"Série temporal – tipo: {tipo_escolhido}",
+        chave_figura="secao1",
     )
 
     # ====== TEXTO DE INTERPRETAÇÃO (SEÇÃO 1) ======
     st.subheader("Interpretação – série por tipo")
 
     anos_min, anos_max = min(anos_disponiveis), max(anos_disponiveis)
-    top3 = rank_media.head(3)
+    # (município, média) dos 3 primeiros, extraídos uma vez como arrays
+    top3 = list(zip(rank_media.index.to_numpy()[:3], rank_media.to_numpy()[:3]))
 
     descricao_top = ""
     if len(top3) >= 1:
-        descricao_top += f"- **{top3.index[0]}** apresenta a maior média no indicador `{tipo_escolhido}` no período, com valor aproximado de **{top3.iloc[0]:.2f}**.\n"
+        descricao_top += f"- **{top3[0][0]}** apresenta a maior média no indicador `{tipo_escolhido}` no período, com valor aproximado de **{top3[0][1]:.2f}**.\n"
     if len(top3) >= 2:
-        descricao_top += f"- **{top3.index[1]}** aparece em segundo lugar, com média em torno de **{top3.iloc[1]:.2f}**.\n"
+        descricao_top += f"- **{top3[1][0]}** aparece em segundo lugar, com média em torno de **{top3[1][1]:.2f}**.\n"
     if len(top3) >= 3:
-        descricao_top += f"- **{top3.index[2]}** ocupa a terceira posição, com média próxima de **{top3.iloc[2]:.2f}**.\n"
+        descricao_top += f"- **{top3[2][0]}** ocupa a terceira posição, com média próxima de **{top3[2][1]:.2f}**.\n"
 
     # Tendência global (média por ano)
-    media_ano = df_tipo.groupby("ano")["valor"].mean().sort_values()
+    media_ano = media_tipo_ano.loc[tipo_escolhido].sort_values()
     if len(media_ano) >= 2:
         primeiro_ano, ultimo_ano = media_ano.index[0], media_ano.index[-1]
         valor_ini, valor_fim = media_ano.iloc[0], media_ano.iloc[-1]
@@ -322,10 +605,12 @@ elif escala_sec2 == "Z-score por tipo":
     col_valor_sec2 = "valor_zscore_tipo"
     ylabel_sec2 = "Indicador normalizado (z-score por tipo)"
 
-df_city = df_long[
-    (df_long["Município"] == municipio_escolhido) &
-    (df_long["tipo"].isin(tipos_selecionados))
-].copy()
+if tipos_selecionados:
+    df_city = pd.concat([fatiar_df_long(df_long, t, municipio_escolhido) for t in tipos_selecionados])
+else:
+    df_city = df_long.iloc[0:0]
+if col_valor_sec2 != "valor":
+    df_city = adicionar_normalizacao(df_city, estatisticas_por_tipo(df_long, chave_upload), col_valor_sec2)
 
 if df_city.empty or df_city[col_valor_sec2].notna().sum() == 0:
     st.warning("Não há dados suficientes para essa combinação de município, tipos e escala.")
@@ -338,6 +623,7 @@ else:
         xlabel="Ano",
         ylabel=ylabel_sec2,
         title=f"Séries temporais por tipo – {municipio_escolhido} ({escala_sec2})",
+        chave_figura="secao2",
     )
 
     # ====== TEXTO DE INTERPRETAÇÃO (SEÇÃO 2) ======
@@ -345,23 +631,27 @@ else:
 
     anos_min_city, anos_max_city = df_city["ano"].min(), df_city["ano"].max()
     ano_final = df_city["ano"].max()
-    df_final_ano = df_city[df_city["ano"] == ano_final]
 
-    resumo_final = df_final_ano.groupby("tipo")[col_valor_sec2].mean().sort_values(ascending=False)
+    # Médias por (ano, tipo) numa passada; o último ano sai de um .loc no índice
+    media_city = df_city.groupby(["ano", "tipo"], observed=True)[col_valor_sec2].mean()
+    resumo_final = media_city.loc[ano_final].sort_values(ascending=False)
+
+    tipos_resumo = resumo_final.index.to_numpy()
+    valores_resumo = resumo_final.to_numpy()
 
     texto_resumo = ""
-    if not resumo_final.empty:
+    if len(valores_resumo) > 0:
         # Top indicador no último ano
-        tipo_top = resumo_final.index[0]
-        valor_top = resumo_final.iloc[0]
+        tipo_top = tipos_resumo[0]
+        valor_top = valores_resumo[0]
         texto_resumo += (
             f"- No ano mais recente (**{ano_final}**), o indicador **`{tipo_top}`** "
             f"apresenta o maior valor médio na escala escolhida (**{escala_sec2}**), com cerca de **{valor_top:.2f}**.\n"
         )
 
-        if len(resumo_final) > 1:
-            tipo_low = resumo_final.index[-1]
-            valor_low = resumo_final.iloc[-1]
+        if len(valores_resumo) > 1:
+            tipo_low = tipos_resumo[-1]
+            valor_low = valores_resumo[-1]
             diff = valor_top - valor_low
             texto_resumo += (
                 f"- O indicador com menor valor no mesmo ano é **`{tipo_low}`**, "
@@ -404,7 +694,7 @@ Bom para responder:
 - Qual é a diferença entre o melhor e o pior colocado?
 """)
 
-col_tipo_ano1, col_tipo_ano2 = st.columns(2)
+col_tipo_ano1, col_tipo_ano2, col_tipo_ano3 = st.columns(3)
 
 with col_tipo_ano1:
     tipo_rank = st.selectbox(
@@ -420,47 +710,65 @@ with col_tipo_ano2:
         index=len(anos_disponiveis) - 1  # último ano
     )
 
-df_rank = df_long[
-    (df_long["tipo"] == tipo_rank) &
-    (df_long["ano"] == ano_rank)
-].copy()
+with col_tipo_ano3:
+    # Com centenas de municípios o gráfico fica ilegível (e lento para desenhar)
+    max_barras = st.slider("Municípios exibidos", 10, 100, 40)
 
-if df_rank.empty or df_rank["valor"].notna().sum() == 0:
+# Ranking já ordenado uma vez por upload; tipo sem coluna para esse ano fica vazio
+posicoes_rank = ordem_rankings(df_long, chave_upload).get((tipo_rank, ano_rank), [])
+df_rank_sorted = df_long.iloc[posicoes_rank][["Município", "valor"]]
+
+if df_rank_sorted.empty or df_rank_sorted["valor"].notna().sum() == 0:
     st.warning("Não há dados numéricos para esse ano e tipo.")
 else:
-    df_rank_sorted = df_rank.sort_values("valor", ascending=False)
 
-    fig_rank, ax_rank = plt.subplots(figsize=(10, 6))
-    ax_rank.barh(df_rank_sorted["Município"], df_rank_sorted["valor"])
-    ax_rank.invert_yaxis()
-    ax_rank.set_title(f"Ranking de municípios – tipo `{tipo_rank}` em {ano_rank}")
-    ax_rank.set_xlabel("Valor do indicador (original)")
-    ax_rank.set_ylabel("Município")
-    fig_rank.tight_layout()
-    st.pyplot(fig_rank)
+    # Desenha só os extremos do ranking, separados por uma barra vazia "…"
+    df_rank_plot = df_rank_sorted.dropna(subset=["valor"])
+    rotulos = df_rank_plot["Município"].astype(str).tolist()
+    valores = df_rank_plot["valor"].tolist()
+    titulo_rank = f"Ranking de municípios – tipo `{tipo_rank}` em {ano_rank}"
+    if len(rotulos) > max_barras:
+        n_topo = max_barras // 2
+        n_base = max_barras - n_topo
+        rotulos = rotulos[:n_topo] + ["…"] + rotulos[-n_base:]
+        valores = valores[:n_topo] + [np.nan] + valores[-n_base:]
+        titulo_rank += f" ({n_topo} maiores e {n_base} menores)"
+
+    fig_rank, ax_rank, lock_rank = obter_figura("secao3", (10, 6))
+    with lock_rank:
+        ax_rank.clear()
+        ax_rank.barh(rotulos, valores)
+        ax_rank.invert_yaxis()
+        ax_rank.set_title(titulo_rank)
+        ax_rank.set_xlabel("Valor do indicador (original)")
+        ax_rank.set_ylabel("Município")
+        fig_rank.tight_layout()
+        exibir_figura(fig_rank)
 
     # ====== TEXTO DE INTERPRETAÇÃO (SEÇÃO 3) ======
     st.subheader("Interpretação – ranking por ano")
 
-    top3_rank = df_rank_sorted.head(3)
-    bottom3_rank = df_rank_sorted.tail(3)
+    munis_rank = df_rank_sorted["Município"].to_numpy()
+    valores_rank = df_rank_sorted["valor"].to_numpy()
+    top3_rank = list(zip(munis_rank[:3], valores_rank[:3]))
+    bottom3_rank = munis_rank[-3:]
 
     texto_rank = ""
 
-    if not top3_rank.empty:
-        texto_rank += f"- O município com maior valor no indicador **`{tipo_rank}`** em **{ano_rank}** é **{top3_rank.iloc[0]['Município']}**, com aproximadamente **{top3_rank.iloc[0]['valor']:.2f}**.\n"
+    if len(top3_rank) >= 1:
+        texto_rank += f"- O município com maior valor no indicador **`{tipo_rank}`** em **{ano_rank}** é **{top3_rank[0][0]}**, com aproximadamente **{top3_rank[0][1]:.2f}**.\n"
     if len(top3_rank) >= 2:
-        texto_rank += f"- Em seguida aparecem **{top3_rank.iloc[1]['Município']}** (~{top3_rank.iloc[1]['valor']:.2f}) e **{top3_rank.iloc[2]['Município']}** (~{top3_rank.iloc[2]['valor']:.2f}).\n"
+        texto_rank += f"- Em seguida aparecem **{top3_rank[1][0]}** (~{top3_rank[1][1]:.2f}) e **{top3_rank[2][0]}** (~{top3_rank[2][1]:.2f}).\n"
 
     if len(df_rank_sorted) > 3:
         texto_rank += (
             f"- Na outra extremidade, os menores valores são observados em municípios como "
-            f"**{bottom3_rank.iloc[0]['Município']}**, **{bottom3_rank.iloc[1]['Município']}** "
-            f"e **{bottom3_rank.iloc[2]['Município']}**.\n"
+            f"**{bottom3_rank[0]}**, **{bottom3_rank[1]}** "
+            f"e **{bottom3_rank[2]}**.\n"
         )
 
-    max_val = df_rank_sorted["valor"].max()
-    min_val = df_rank_sorted["valor"].min()
+    max_val = np.nanmax(valores_rank)
+    min_val = np.nanmin(valores_rank)
     diff_val = max_val - min_val
 
     texto_rank += (
@@ -540,16 +848,22 @@ elif escala_sec4 == "Z-score por tipo":
     col_valor_sec4 = "valor_zscore_tipo"
     ylabel_sec4 = "Indicador normalizado (z-score por tipo)"
 
-df_comp = df_long[
-    (df_long["tipo"].isin(tipos_sel4)) &
-    (df_long["Município"].isin(cidades_sel4))
-].copy()
+if tipos_sel4 and cidades_sel4:
+    df_comp = pd.concat([
+        fatiar_df_long(df_long, t, c) for c in cidades_sel4 for t in tipos_sel4
+    ])
+else:
+    df_comp = df_long.iloc[0:0]
+if col_valor_sec4 != "valor":
+    df_comp = adicionar_normalizacao(df_comp, estatisticas_por_tipo(df_long, chave_upload), col_valor_sec4)
 
 if df_comp.empty or df_comp[col_valor_sec4].notna().sum() == 0:
     st.warning("Não há dados suficientes para essa combinação de cidades, tipos e escala.")
 else:
     # Cria uma label combinando Município e Tipo
-    df_comp["serie"] = df_comp["Município"] + " – " + df_comp["tipo"]
+    df_comp = df_comp.assign(
+        serie=df_comp["Município"].astype(str) + " – " + df_comp["tipo"].astype(str)
+    )
 
     plot_serie_temporal(
         df_comp,
@@ -559,6 +873,7 @@ else:
         xlabel="Ano",
         ylabel=ylabel_sec4,
         title=f"Comparação entre cidades e tipos ({escala_sec4})",
+        chave_figura="secao4",
     )
 
     st.subheader("Interpretação – comparação entre cidades e tipos")
@@ -569,18 +884,21 @@ else:
 
     resumo4 = df_final4.groupby("serie")[col_valor_sec4].mean().sort_values(ascending=False)
 
+    series_resumo4 = resumo4.index.to_numpy()
+    valores_resumo4 = resumo4.to_numpy()
+
     texto4 = ""
-    if not resumo4.empty:
-        serie_top = resumo4.index[0]
-        valor_top = resumo4.iloc[0]
+    if len(valores_resumo4) > 0:
+        serie_top = series_resumo4[0]
+        valor_top = valores_resumo4[0]
         texto4 += (
             f"- No ano mais recente (**{ano_final4}**), a combinação **{serie_top}** "
             f"apresenta o maior valor médio na escala `{escala_sec4}`, com cerca de **{valor_top:.2f}**.\n"
         )
 
-        if len(resumo4) > 1:
-            serie_low = resumo4.index[-1]
-            valor_low = resumo4.iloc[-1]
+        if len(valores_resumo4) > 1:
+            serie_low = series_resumo4[-1]
+            valor_low = valores_resumo4[-1]
             diff4 = valor_top - valor_low
             texto4 += (
                 f"- A combinação com menor valor é **{serie_low}**, com média de aproximadamente **{valor_low:.2f}**, "